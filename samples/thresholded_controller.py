@@ -17,6 +17,7 @@ Copyright (C) 2025 Andrés Zelcer and others
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from __future__ import annotations
+import math
 import numpy as np
 from takyaq.base_classes import BaseController
 
@@ -67,16 +68,16 @@ class ThresholdPIController(BaseController):
             x_shift = y_shift = 0.0
         else:
             x_shift, y_shift = np.nanmean(xy_shifts, axis=0)
-        if x_shift is np.nan:
+        if not math.isfinite(x_shift):
             print("x shift is NAN")
             x_shift = 0.0
-        if y_shift is np.nan:
+        if not math.isfinite(y_shift):
             print("y shift is NAN")
             y_shift = 0.0
         error = np.array((x_shift, y_shift, z_shift))
 
-        Kp_to_use = self._Kp.copy()
-        Kp_to_use[np.abs(error) >= self._threshold] = self._Kp_plusultra
+        Kp_to_use = np.where(np.abs(error) >= self._threshold,
+                             self._Kp_plusultra, self._Kp)
 
         rv = np.clip(error * Kp_to_use, -self._max_disp, self._max_disp)
         return -rv
@@ -78,7 +78,9 @@ class BaseController(_ABC):
 
         Any parameter can be NAN, so it must be properly handled
 
-        If xy_shifts has not been measured, a None will be received.
+        If xy_shifts has not been measured, a None will be received. Otherwise, it
+        is an Nx2 array of x and y shifts for each ROI. The provided controllers
+        process C-contiguous float32 or float64 arrays without copying them.
 
         Must return a 3-item tuple representing the response in x, y and z
         """
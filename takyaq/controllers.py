@@ -18,6 +18,8 @@ Copyright (C) 2025 Andrés Zelcer and others
     You should have received a copy of the GNU Affero General Public License
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+from abc import abstractclassmethod as _abstractclassmethod
+import math as _math
 import numpy as _np
 import logging as _lgn
 from typing import Optional as _Optional, Union as _Union, Tuple as _Tuple
@@ -28,39 +30,308 @@ _lgn.basicConfig()
 _lgr = _lgn.getLogger(__name__)
 _lgr.setLevel(_lgn.DEBUG)
 
+try:
+    from numba import njit as _njit
+    _HAS_NUMBA = True
+except ImportError:
+    _lgr.info("numba not available: outlier rejection falls back to numpy")
+    _HAS_NUMBA = False
 
-class PIController(_BaseController):
-    """PI Controller."""
+    def _njit(*args, **kwargs):
+        """Do nothing replacement of numba.njit.
 
-    _Kp = _np.ones((3,))
-    _Ki = _np.ones((3,))
-    _deriv = _np.zeros((3,))
-    _last_e = _np.zeros((3,))
-    _cum = _np.zeros((3,))
-    next_val = 0
-    _last_times = _np.zeros((3,))
+        Uncompiled kernels are slower than numpy, so they are replaced by their
+        numpy versions when numba is not available.
+        """
+        def decorator(func):
+            return func
+        return decorator
+
+# All fast math flags except 'nnan' and 'ninf': kernels rely on NaN checks
+_FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+
+# Shifts arrays of these types are handled by the kernels without conversion
+_KERNEL_DTYPES = (_np.float32, _np.float64)
+
+
+def _as_kernel_input(xy: _np.ndarray) -> _np.ndarray:
+    """Return xy as a contiguous array of a type handled by the kernels.
+
+    No copy is made if xy already is one.
+    """
+    if xy.dtype in _KERNEL_DTYPES:
+        return _np.ascontiguousarray(xy)
+    return _np.ascontiguousarray(xy, dtype=_np.float64)
+
+
+def _kernel(func):
+    """Compile a function with the options shared by all kernels in this module.
+
+    Compiled code is cached on disk, so it is only built once per installation.
+    """
+    return _njit(cache=True, fastmath=_FASTMATH, boundscheck=False)(func)
+
+
+@_kernel
+def _nanmean_xy(xy: _np.ndarray) -> _Tuple[float, float]:
+    """Return the mean of each column of a Nx2 array, ignoring NaNs.
+
+    Equivalent to `numpy.nanmean(xy, axis=0)`, in a single pass and without
+    temporary arrays.
+    """
+    sum_x = sum_y = 0.
+    n_x = n_y = 0
+    for i in range(xy.shape[0]):
+        x = xy[i, 0]
+        y = xy[i, 1]
+        if x == x:
+            sum_x += x
+            n_x += 1
+        if y == y:
+            sum_y += y
+            n_y += 1
+    return (sum_x / n_x if n_x else _np.nan,
+            sum_y / n_y if n_y else _np.nan)
+
+
+def _nanmean_xy_numpy(xy: _np.ndarray) -> _Tuple[float, float]:
+    """Numpy version of `_nanmean_xy`, used when numba is not available."""
+    x_shift, y_shift = _np.nanmean(xy, axis=0)
+    return x_shift, y_shift
+
+
+@_kernel
+def _sd_trim(xy: _np.ndarray, threshold: float) -> _Tuple[float, float, int]:
+    """Iteratively reject outliers using the standard deviation criterion.
+
+    A position is an outlier if any of its coordinates is further than `threshold`
+    standard deviations from the mean of the accepted positions. The process is
+    repeated until the number of accepted positions is stable or lower than 3.
+
+    Parameters
+    ----------
+    xy : numpy.ndarray
+        Contiguous float32 or float64 Nx2 array of positions. NaN values are
+        ignored.
+    threshold : float
+        Rejection threshold, in units of standard deviation.
+
+    Returns
+    -------
+    (x, y, n_valids): the mean position of the accepted positions and their number.
+    """
+    n = xy.shape[0]
+    outliers = _np.zeros(n, dtype=_np.bool_)
+    last_n_valids = n
+    while True:
+        # Welford's algorithm: mean and deviation in a single pass
+        n_x = n_y = 0
+        mean_x = mean_y = 0.
+        m2_x = m2_y = 0.
+        for i in range(n):
+            if outliers[i]:
+                continue
+            x = xy[i, 0]
+            y = xy[i, 1]
+            if x == x:
+                n_x += 1
+                delta = x - mean_x
+                mean_x += delta / n_x
+                m2_x += delta * (x - mean_x)
+            if y == y:
+                n_y += 1
+                delta = y - mean_y
+                mean_y += delta / n_y
+                m2_y += delta * (y - mean_y)
+        if n_x:
+            std_x = _math.sqrt(m2_x / n_x)
+        else:
+            mean_x = std_x = _np.nan
+        if n_y:
+            std_y = _math.sqrt(m2_y / n_y)
+        else:
+            mean_y = std_y = _np.nan
+        # |d| / std > threshold, without divisions in the row loop
+        thr_x = threshold * std_x
+        thr_y = threshold * std_y
+        n_valids = 0
+        for i in range(n):
+            outliers[i] = (abs(xy[i, 0] - mean_x) > thr_x or
+                           abs(xy[i, 1] - mean_y) > thr_y)
+            if not outliers[i]:
+                n_valids += 1
+        if n_valids < 3 or n_valids == last_n_valids:
+            break
+        last_n_valids = n_valids
+    return mean_x, mean_y, n_valids
+
+
+def _sd_trim_numpy(xy: _np.ndarray, threshold: float) -> _Tuple[float, float, int]:
+    """Numpy version of `_sd_trim`, used when numba is not available."""
+    valid_idx = _np.ones((len(xy),), dtype=bool)
+    last_n_valids = len(xy)
+    while True:
+        shifts = _np.nanmean(xy[valid_idx], axis=0)
+        desvs = _np.nanstd(xy[valid_idx], axis=0)
+        outliers = (_np.abs(xy - shifts) > threshold * desvs).any(axis=1)
+        valid_idx = ~outliers
+        n_valids = int(valid_idx.sum())
+        if n_valids < 3 or n_valids == last_n_valids:
+            break
+        last_n_valids = n_valids
+    return shifts[0], shifts[1], n_valids
+
+
+@_kernel
+def _median(values: _np.ndarray) -> float:
+    """Return the median of a 1D array, sorting it in place.
+
+    As numpy.median does, returns NaN if any value is NaN.
+    """
+    n = values.shape[0]
+    # insertion sort: we expect just a few values
+    for i in range(n):
+        v = values[i]
+        if v != v:
+            return _np.nan
+        j = i - 1
+        while j >= 0 and values[j] > v:
+            values[j + 1] = values[j]
+            j -= 1
+        values[j + 1] = v
+    half = n // 2
+    if n % 2:
+        return values[half]
+    return (values[half - 1] + values[half]) / 2
+
+
+@_kernel
+def _mad_trim(xy: _np.ndarray, threshold: float) -> _Tuple[float, float, int]:
+    """Reject outliers using the median absolute deviation criterion.
+
+    A position is an outlier if the modified Z-score of any of its coordinates is
+    greater than `threshold`.
+
+    Parameters
+    ----------
+    xy : numpy.ndarray
+        Contiguous float32 or float64 Nx2 array of positions. NaN values are
+        ignored.
+    threshold : float
+        Rejection threshold for the modified Z-score.
+
+    Returns
+    -------
+    (x, y, n_valids): the mean position of the accepted positions and their number.
+    """
+    n = xy.shape[0]
+    mean_x, mean_y = _nanmean_xy(xy)
+    adifs_x = _np.empty(n)
+    adifs_y = _np.empty(n)
+    for i in range(n):
+        adifs_x[i] = abs(xy[i, 0] - mean_x)
+        adifs_y[i] = abs(xy[i, 1] - mean_y)
+    # 0.6745 * adif / MAD > threshold
+    thr_x = threshold * _median(adifs_x) / 0.6745
+    thr_y = threshold * _median(adifs_y) / 0.6745
+    sum_x = sum_y = 0.
+    n_x = n_y = 0
+    n_valids = 0
+    for i in range(n):
+        x = xy[i, 0]
+        y = xy[i, 1]
+        if abs(x - mean_x) > thr_x or abs(y - mean_y) > thr_y:
+            continue
+        n_valids += 1
+        if x == x:
+            sum_x += x
+            n_x += 1
+        if y == y:
+            sum_y += y
+            n_y += 1
+    return (sum_x / n_x if n_x else _np.nan,
+            sum_y / n_y if n_y else _np.nan,
+            n_valids)
+
+
+def _mad_trim_numpy(xy: _np.ndarray, threshold: float) -> _Tuple[float, float, int]:
+    """Numpy version of `_mad_trim`, used when numba is not available."""
+    adifs = _np.abs(xy - _np.nanmean(xy, axis=0))
+    # 0.6745 * adif / MAD > threshold
+    outliers = (adifs > threshold * _np.median(adifs, axis=0) / 0.6745).any(axis=1)
+    valid_idx = ~outliers
+    x_shift, y_shift = _np.nanmean(xy[valid_idx], axis=0)
+    return x_shift, y_shift, int(valid_idx.sum())
+
+
+def _warm_up_kernels():
+    """Load or compile the kernels for the argument types used by the controllers.
+
+    Compiling on the first call would stall the first stabilization step.
+    """
+    for dtype in _KERNEL_DTYPES:
+        xy = _np.zeros((4, 2), dtype=dtype)
+        _nanmean_xy(xy)
+        _sd_trim(xy, 2.0)
+        _mad_trim(xy, 1.5)
+
+
+if _HAS_NUMBA:
+    _warm_up_kernels()
+else:
+    _nanmean_xy = _nanmean_xy_numpy
+    _sd_trim = _sd_trim_numpy
+    _mad_trim = _mad_trim_numpy
+
+
+def _as_triplet(value: _Union[float, _Tuple[float]]) -> _Tuple[float, float, float]:
+    """Expand a single value or a 3-item sequence into a tuple of 3 floats."""
+    x, y, z = _np.broadcast_to(_np.asarray(value, dtype=float), (3,))
+    return float(x), float(y), float(z)
+
+
+class _BasePIController(_BaseController):
+    """Base class for PI Controllers.
+
+    The responses involve only 3 values, so internal data is kept as plain floats:
+    numpy overhead is much higher than the actual calculations for such small data.
+
+    Subclasses must implement `_compute_xy_shift`, that reduces the shifts of all
+    the XY ROIs to a single shift.
+    """
 
     def __init__(self, Kp: _Union[float, _Tuple[float]] = 1.,
                  Ki: _Union[float, _Tuple[float]] = 1.,
                  ):
         self.set_Kp(Kp)
         self.set_Ki(Ki)
+        self.reset_xy(0)
+        self.reset_z()
 
     def set_Kp(self, Kp: _Union[float, _Tuple[float]]):
-        self._Kp[:] = _np.array(Kp)
+        self._Kp_x, self._Kp_y, self._Kp_z = _as_triplet(Kp)
 
     def set_Ki(self, Ki: _Union[float, _Tuple[float]]):
-        self._Ki[:] = _np.array(Ki)
+        self._Ki_x, self._Ki_y, self._Ki_z = _as_triplet(Ki)
 
     def reset_xy(self, n_xy_rois: int):
         """Initialize all necesary internal structures for XY."""
-        self._cum[0:2] = 0.
-        self._last_times[0:2] = 0.
+        self._cum_x = self._cum_y = 0.
+        self._last_time_x = self._last_time_y = 0.
 
     def reset_z(self):
         """Initialize all necesary internal structures for Z."""
-        self._cum[2] = 0.
-        self._last_times[2] = 0.
+        self._cum_z = 0.
+        self._last_time_z = 0.
+
+    @_abstractclassmethod
+    def _compute_xy_shift(self, xy_shifts: _np.ndarray) -> _Tuple[float, float]:
+        """Return the x and y shifts given the shifts of every ROI.
+
+        xy_shifts is a contiguous float32 or float64 Nx2 array. Any value can be NAN.
+        """
+        ...
 
     def response(self, t: float, xy_shifts: _Optional[_np.ndarray], z_shift: float):
         """Process a mesaurement of the displacements.
@@ -74,185 +345,90 @@ class PIController(_BaseController):
         if xy_shifts is None:
             x_shift = y_shift = 0.0
         else:
-            x_shift, y_shift = _np.nanmean(xy_shifts, axis=0)
-        if x_shift is _np.nan:
+            x_shift, y_shift = self._compute_xy_shift(_as_kernel_input(xy_shifts))
+        if not _math.isfinite(x_shift):
             _lgr.warning("x shift is NAN")
             x_shift = 0.0
-        if y_shift is _np.nan:
+        if not _math.isfinite(y_shift):
             _lgr.warning("y shift is NAN")
             y_shift = 0.0
+        if not _math.isfinite(z_shift):
+            _lgr.warning("z shift is NAN")
+            z_shift = 0.0
+
+        # Attributes are read once into locals, as this runs on every frame.
+        # A non-positive last time means a fresh start. delta t is capped to 1 s to
+        # protect against suspended processes
+        last_x = self._last_time_x
+        last_y = self._last_time_y
+        last_z = self._last_time_z
+        cum_x = self._cum_x
+        cum_y = self._cum_y
+        cum_z = self._cum_z
+        if last_x > 0.:
+            cum_x += x_shift * min(t - last_x, 1.)
+        if last_y > 0.:
+            cum_y += y_shift * min(t - last_y, 1.)
+        if last_z > 0.:
+            cum_z += z_shift * min(t - last_z, 1.)
+        self._cum_x = cum_x
+        self._cum_y = cum_y
+        self._cum_z = cum_z
+        self._last_time_x = self._last_time_y = self._last_time_z = t
+        return (
+            -(x_shift * self._Kp_x + self._Ki_x * cum_x),
+            -(y_shift * self._Kp_y + self._Ki_y * cum_y),
+            -(z_shift * self._Kp_z + self._Ki_z * cum_z),
+        )
+
+
+class PIController(_BasePIController):
+    """PI Controller."""
 
-        error = _np.array((x_shift, y_shift, z_shift))
-        self._last_times[_np.where(self._last_times <= 0.)] = t
-        delta_t = t - self._last_times
-        delta_t[_np.where(delta_t > 1)] = 1.  # protect against suspended processes
-        self._cum += error * delta_t
-        rv = error * self._Kp + self._Ki * self._cum
-        self._last_times[:] = t
-        return -rv
+    def _compute_xy_shift(self, xy_shifts: _np.ndarray) -> _Tuple[float, float]:
+        """Return the mean shift of all ROIs."""
+        return _nanmean_xy(xy_shifts)
 
 
-class RejectPIControllerSD:
+class RejectPIControllerSD(_BasePIController):
     """PI Controller that rejects outliers."""
 
-    _Kp = _np.ones((3,))
-    _Ki = _np.ones((3,))
-    _deriv = _np.zeros((3,))
-    _last_e = _np.zeros((3,))
-    _cum = _np.zeros((3,))
     _threshold = 2.0
-    next_val = 0
-    _last_times = _np.zeros((3,))
 
     def __init__(self, Kp: _Union[float, _Tuple[float]] = 1.,
                  Ki: _Union[float, _Tuple[float]] = 1.,
                  threshold: float = 2.0,
                  ):
-        self.set_Kp(Kp)
-        self.set_Ki(Ki)
-        self._threshold = threshold  # TODO: seteable
-
-    def set_Kp(self, Kp: _Union[float, _Tuple[float]]):
-        self._Kp[:] = _np.array(Kp)
-
-    def set_Ki(self, Ki: _Union[float, _Tuple[float]]):
-        self._Ki[:] = _np.array(Ki)
-
-    def reset_xy(self, n_xy_rois: int):
-        """Initialize all necesary internal structures for XY."""
-        self._cum[0:2] = 0.
-        self._last_times[0:2] = 0.
+        super().__init__(Kp, Ki)
+        self._threshold = float(threshold)  # TODO: seteable
 
-    def reset_z(self):
-        """Initialize all necesary internal structures for Z."""
-        self._cum[2] = 0.
-        self._last_times[2] = 0.
+    def _compute_xy_shift(self, xy_shifts: _np.ndarray) -> _Tuple[float, float]:
+        """Return the mean shift of the ROIs, rejecting outliers by SD."""
+        if len(xy_shifts) < 4:
+            return _nanmean_xy(xy_shifts)
+        x_shift, y_shift, n_valids = _sd_trim(xy_shifts, self._threshold)
+        if n_valids < 3:
+            _lgr.warning("There might be invalid positions")
+        return x_shift, y_shift
 
-    def response(self, t: float, xy_shifts: _Optional[_np.ndarray], z_shift: float):
-        """Process a mesaurement of the displacements.
 
-        Any parameter can be NAN, so we have to take it into account.
-
-        If xy_shifts has not been measured, a None will be received.
-
-        Must return a 3-item tuple representing the response in x, y and z
-        """
-        if xy_shifts is None:
-            x_shift = y_shift = 0.0
-        elif len(xy_shifts) < 4:
-            x_shift, y_shift = _np.nanmean(xy_shifts, axis=0)
-        else:
-            outliers = _np.zeros((len(xy_shifts),), dtype=bool)
-            valid_idx = ~outliers
-            shifts = _np.nanmean(xy_shifts[valid_idx], axis=0)
-            desvs = _np.nanstd(xy_shifts[valid_idx], axis=0)
-            outliers = ((_np.abs(xy_shifts - shifts) / desvs) >
-                        self._threshold).sum(axis=1, dtype=bool)
-            valid_idx = ~outliers
-            n_valids = valid_idx.sum()  # actual
-            last_n_valids = len(xy_shifts)
-            while n_valids >= 3 and n_valids != last_n_valids:
-                last_n_valids = n_valids
-                shifts = _np.nanmean(xy_shifts[valid_idx], axis=0)
-                desvs = _np.nanstd(xy_shifts[valid_idx], axis=0)
-                outliers = (
-                    (_np.abs(xy_shifts - shifts) / desvs) > self._threshold
-                    ).sum(axis=1, dtype=bool)
-                valid_idx = ~outliers
-                n_valids = valid_idx.sum()
-            if n_valids < 3:
-                _lgr.warning("There might be invalid positions")
-            x_shift, y_shift = shifts
-
-        if x_shift is _np.nan:
-            _lgr.warning("x shift is NAN")
-            x_shift = 0.0
-        if y_shift is _np.nan:
-            _lgr.warning("y shift is NAN")
-            y_shift = 0.0
-
-        error = _np.array((x_shift, y_shift, z_shift))
-        self._last_times[_np.where(self._last_times <= 0.)] = t
-        delta_t = t - self._last_times
-        delta_t[_np.where(delta_t > 1)] = 1.  # protect against suspended processes
-        self._cum += error * delta_t
-        rv = error * self._Kp + self._Ki * self._cum
-        self._last_times[:] = t
-        return -rv
-
-
-class RejectPIControllerMAD:
+class RejectPIControllerMAD(_BasePIController):
     """PI Controller that rejects outliers."""
 
-    _Kp = _np.ones((3,))
-    _Ki = _np.ones((3,))
-    _deriv = _np.zeros((3,))
-    _last_e = _np.zeros((3,))
-    _cum = _np.zeros((3,))
     _threshold = 1.5
-    next_val = 0
-    _last_times = _np.zeros((3,))
 
     def __init__(self, Kp: _Union[float, _Tuple[float]] = 1.,
                  Ki: _Union[float, _Tuple[float]] = 1.,
                  threshold: float = 1.5,
                  ):
-        self.set_Kp(Kp)
-        self.set_Ki(Ki)
-        self._threshold = threshold  # TODO: seteable
-
-    def set_Kp(self, Kp: _Union[float, _Tuple[float]]):
-        self._Kp[:] = _np.array(Kp)
-
-    def set_Ki(self, Ki: _Union[float, _Tuple[float]]):
-        self._Ki[:] = _np.array(Ki)
-
-    def reset_xy(self, n_xy_rois: int):
-        """Initialize all necesary internal structures for XY."""
-        self._cum[0:2] = 0.
-        self._last_times[0:2] = 0.
-
-    def reset_z(self):
-        """Initialize all necesary internal structures for Z."""
-        self._cum[2] = 0.
-        self._last_times[2] = 0.
-
-    def response(self, t: float, xy_shifts: _Optional[_np.ndarray], z_shift: float):
-        """Process a mesaurement of the displacements.
-
-        Any parameter can be NAN, so we have to take it into account.
-
-        If xy_shifts has not been measured, a None will be received.
-
-        Must return a 3-item tuple representing the response in x, y and z
-        """
-        if xy_shifts is None:
-            x_shift = y_shift = 0.0
-        else:
-            shifts = _np.nanmean(xy_shifts, axis=0)
-            if len(xy_shifts) >= 4:
-                adifs = _np.abs(xy_shifts - shifts)
-                MAD = _np.median(adifs, axis=0)
-                aMi = 0.6745 * adifs / MAD
-                outliers = (aMi > self._threshold).sum(axis=1, dtype=bool)
-                valid_idx = ~outliers
-                shifts = _np.nanmean(xy_shifts[valid_idx], axis=0)
-                if valid_idx.sum() < 3:
-                    _lgr.warning("There might be invalid positions")
-            x_shift, y_shift = shifts
-
-        if x_shift is _np.nan:
-            _lgr.warning("x shift is NAN")
-            x_shift = 0.0
-        if y_shift is _np.nan:
-            _lgr.warning("y shift is NAN")
-            y_shift = 0.0
-
-        error = _np.array((x_shift, y_shift, z_shift))
-        self._last_times[_np.where(self._last_times <= 0.)] = t
-        delta_t = t - self._last_times
-        delta_t[_np.where(delta_t > 1)] = 1.  # protect against suspended processes
-        self._cum += error * delta_t
-        rv = error * self._Kp + self._Ki * self._cum
-        self._last_times[:] = t
-        return -rv
+        super().__init__(Kp, Ki)
+        self._threshold = float(threshold)  # TODO: seteable
+
+    def _compute_xy_shift(self, xy_shifts: _np.ndarray) -> _Tuple[float, float]:
+        """Return the mean shift of the ROIs, rejecting outliers by MAD."""
+        if len(xy_shifts) < 4:
+            return _nanmean_xy(xy_shifts)
+        x_shift, y_shift, n_valids = _mad_trim(xy_shifts, self._threshold)
+        if n_valids < 3:
+            _lgr.warning("There might be invalid positions")
+        return x_shift, y_shift
@@ -21,8 +21,10 @@ Copyright (C) 2025 Andrés Zelcer and others
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import logging as _lgn
+import io as _io
 import json as _json
-from itertools import repeat as _repeat, product as _product
+import os as _os
+import time as _time
 from typing import List as _List, Tuple as _Tuple
 from PyQt5.QtCore import pyqtSlot, QTimer, Qt
 from PyQt5.QtGui import QDoubleValidator
@@ -40,15 +42,42 @@ from PyQt5.QtWidgets import (
 )
 import numpy as np
 import pyqtgraph as _pg
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
 _lgr = _lgn.getLogger(__name__)
 _lgr.setLevel(_lgn.DEBUG)
 
+_REFRESH_DELAY_MS = 200  # delay before refreshing the pattern preview
+
 
 def text2list(txt: str) -> np.ndarray:
     r"""Interpret a text as an Nx3 array.
 
     Expects empty spaces (' ', '\t') or semicolons as spacers. We avoid commas as
     spacers as it is the decimal separator in many languages.
+
+    Returns a 3xN array with the x, y and t values in each row.
+    """
+    clean = txt.replace(';', ' ')
+    if not clean.strip():
+        return np.empty((3, 0))
+    try:
+        data = np.loadtxt(_io.StringIO(clean), dtype=np.float64, comments=None,
+                          ndmin=2)
+    except ValueError:
+        return _text2list_by_line(txt)
+    if data.shape[1] != 3:
+        return _text2list_by_line(txt)
+    return data.T
+
+
+def _text2list_by_line(txt: str) -> np.ndarray:
+    """Interpret a text as an Nx3 array, line by line, with `float`.
+
+    Slow, only used when numpy can not parse the text. It accepts everything
+    `float` does, and raises an exception that names the offending line or value.
     """
     x = []
     y = []
@@ -69,7 +98,7 @@ def text2list(txt: str) -> np.ndarray:
 
 def list2txt(positions: _List[_Tuple[float, float, float]]) -> str:
     """Render an Nx3 array as text."""
-    return '\n'.join([' '.join([str(c) for c in p]) for p in positions])
+    return '\n'.join(['{} {} {}'.format(*p) for p in positions])
 
 
 def _create_square_array(n_points: int, L: float, period: float):
@@ -78,7 +107,11 @@ def _create_square_array(n_points: int, L: float, period: float):
     Note that n_points vertexes give n_points-1 spaces.
     """
     rng = np.linspace(0, 1, n_points)
-    rv = [(x, y, t) for (y, x), t in zip(_product(rng, rng), _repeat(period))]
+    X, Y = np.meshgrid(rng, rng, indexing='xy')
+    rv = np.empty((n_points * n_points, 3))
+    rv[:, 0] = X.ravel()
+    rv[:, 1] = Y.ravel()
+    rv[:, 2] = period
     return {"L": L, "positions": rv}
 
 
@@ -90,8 +123,16 @@ class PatternWindow(QFrame):
         if parent:
             self.setWindowFlag(Qt.WindowCloseButtonHint, False)
         self._stabilizer = stabilizer
+        self._parsed = None  # last result of _interpret, while the text is unchanged
+        self._preview_x = np.empty((0,))  # preview buffers, reused between plots
+        self._preview_y = np.empty((0,))
         self._init_gui()
+        self._refresh_timer = QTimer()  # coalesces preview refreshes
+        self._refresh_timer.setSingleShot(True)
+        self._refresh_timer.timeout.connect(self._refresh_preview)
         self._timer = QTimer()
+        self._timer.setTimerType(Qt.PreciseTimer)
+        self._timer.setSingleShot(True)
         self._timer.timeout.connect(self.click)
         self.setWindowTitle('Patterns')
 
@@ -103,6 +144,7 @@ class PatternWindow(QFrame):
         definition_layout = QVBoxLayout()
         definition_gb.setLayout(definition_layout)
         self.points_te = QTextEdit()
+        self.points_te.textChanged.connect(self._invalidate_parsed)
         self.points_te.setToolTip(
             """Enter a list of vertexes for the pattern, one vertex per line.
 Each vertex is specified by 3 numbers separated by spaces: x shift, y shift and residence time.
@@ -112,6 +154,7 @@ Shifts are specified in units of the the 'L' parameter, and time is in seconds."
         L_layout.addWidget(QLabel("L / nm"))
         self._length_le = QLineEdit("10.0")
         self._length_le.setValidator(QDoubleValidator(0, 200., 2))
+        self._length_le.textChanged.connect(self._invalidate_parsed)
         L_layout.addWidget(self._length_le)
         xtra_gb = QGroupBox("Extra shift / nm")
         xtra_shift_layout = QHBoxLayout()
@@ -162,8 +205,12 @@ Shifts are specified in units of the the 'L' parameter, and time is in seconds."
             bottom=("X shift", "nm"), left=("Y shift", "nm")
         )
 
+        # Build brush and pen once, so they are not recreated on each update
+        self._preview_brush = _pg.mkBrush(255, 0, 0)
+        self._preview_pen = _pg.mkPen(None)
         self.xyDataItem = self.xyplotItem.plot(
-            [], symbolBrush=(255, 0, 0), symbolSize=10, symbolPen=None
+            [], symbol='o', symbolBrush=self._preview_brush, symbolSize=10,
+            symbolPen=self._preview_pen, pxMode=True,
         )
         layout.addWidget(definition_gb)
         layout.addWidget(self.xyPoint)
@@ -194,12 +241,12 @@ Shifts are specified in units of the the 'L' parameter, and time is in seconds."
 
     def _start(self):
         """Start moving."""
-        points = self._interpret()
+        points = self._do_interpret()
         if not points:
             _lgr.info("Wrong format for positions list")
             return
-        self._points = np.array(points['positions'])
-        if not len(self._points):
+        positions = points['positions']
+        if not len(positions):
             _lgr.warning("Empty position list")
             return
         shift_x, shift_y = (0., 0.)
@@ -208,14 +255,21 @@ Shifts are specified in units of the the 'L' parameter, and time is in seconds."
                 shift_x, shift_y = self._read_xtras()
             except Exception as e:
                 _lgr.warning("Invalid extra shift: %s (%s)", type(e), e)
-        self._points[:, 0:2] *= points['L']
-        self._points[:, 0] += shift_x
-        self._points[:, 1] += shift_y
-        self._timer.setInterval(0)
+        # Each column is processed on its own, so the parsed array is not copied.
+        # XY targets are kept as python floats, to skip numpy scalar extraction on
+        # each step
+        xs = positions[:, 0] * points['L'] + shift_x
+        ys = positions[:, 1] * points['L'] + shift_y
+        self._xy_list = list(zip(xs.tolist(), ys.tolist()))
+        # Times at which each step ends, relative to the start of the pattern.
+        # Scheduling on them keeps delays from accumulating over long patterns
+        self._deadlines_ms = (np.cumsum(positions[:, 2]) * 1000).tolist()
+        self._last_xy = None
         self._current_step = 0
         self.startButton.setEnabled(False)
         self.stopButton.setEnabled(True)
-        self._timer.start()
+        self._t0_ms = _time.monotonic() * 1000
+        self._timer.start(0)
 
     def _finish_pattern(self):
         """Stop timer, restore buttons and reset position."""
@@ -230,21 +284,58 @@ Shifts are specified in units of the the 'L' parameter, and time is in seconds."
 
         Move to next step or finish.
         """
-        if self._current_step >= len(self._points):
+        if self._current_step >= len(self._xy_list):
             self._finish_pattern()
             _lgr.info("Pattern finished")
             return
-        self._stabilizer.shift_reference(*self._points[self._current_step][0:2], 0.)
-        self._timer.setInterval(int(self._points[self._current_step, 2] * 1000))
+        xy = self._xy_list[self._current_step]
+        if xy != self._last_xy:  # vertexes may repeat, e.g. on longer dwells
+            self._stabilizer.shift_reference(xy[0], xy[1], 0.)
+            self._last_xy = xy
+        due_ms = self._t0_ms + self._deadlines_ms[self._current_step]
+        self._timer.start(max(0, int(due_ms - _time.monotonic() * 1000)))
         self._current_step += 1
 
-    def _interpret(self) -> dict:
-        """Produce a pattern dict from user provided data."""
+    def _invalidate_parsed(self, *args):
+        """Forget the last interpreted pattern after the user changes it."""
+        self._parsed = None
+
+    def _interpret(self, *args):
+        """Schedule a refresh of the preview.
+
+        Back-to-back requests within _REFRESH_DELAY_MS are merged into a single one.
+        """
+        self._refresh_timer.start(_REFRESH_DELAY_MS)
+
+    def _refresh_preview(self):
+        """Interpret the pattern for the preview.
+
+        _do_interpret already logs a warning for errors in the pattern.
+        """
         try:
-            x, y, t = text2list(self.points_te.toPlainText())
+            self._do_interpret()
+        except Exception as e:
+            _lgr.debug("Preview not refreshed: %s (%s)", type(e), e)
+
+    def _do_interpret(self) -> dict:
+        """Produce a pattern dict from user provided data.
+
+        The result is reused until the user changes the pattern text or L.
+        """
+        if self._parsed is not None:
+            return self._parsed
+        try:
+            xyt = text2list(self.points_te.toPlainText())
             L = float(self._length_le.text())
-            rv = {"L": L, 'positions': [v for v in zip(x, y, t)]}
-            self.xyDataItem.setData(np.array(x) * L, np.array(y) * L)
+            rv = {"L": L, 'positions': xyt.T}
+            n_points = xyt.shape[1]
+            if self._preview_x.shape[0] != n_points:
+                self._preview_x = np.empty((n_points,))
+                self._preview_y = np.empty((n_points,))
+            np.multiply(xyt[0], L, out=self._preview_x)
+            np.multiply(xyt[1], L, out=self._preview_y)
+            self.xyDataItem.setData(self._preview_x, self._preview_y)
+            self._parsed = rv
             return rv
         except Exception as e:
             _lgr.warning("Error %s parsing text: %s", type(e), e, )
@@ -254,14 +345,18 @@ Shifts are specified in units of the the 'L' parameter, and time is in seconds."
     def load_dialog(self, clicked: bool):
         """Load file dialog."""
         filename = QFileDialog.getOpenFileName(
-            self, "Select pattern", "", "json files (*.json);;all files (*.*)")
+            self, "Select pattern", "",
+            "json files (*.json);;numpy files (*.npy);;csv files (*.csv);;"
+            "all files (*.*)")
         if filename[0]:
             try:
                 self._do_load(filename[0])
-                self._interpret()
             except Exception as e:
-                _lgr.warning("Error %s (%s) opening and interpreting file %s",
+                _lgr.warning("Error %s (%s) opening file %s",
                              type(e), e, filename[0])
+            else:
+                # Errors in the loaded pattern are logged when it is interpreted
+                self._interpret()
 
     @pyqtSlot(bool)
     def save_dialog(self, clicked: bool):
@@ -272,24 +367,52 @@ Shifts are specified in units of the the 'L' parameter, and time is in seconds."
             self._do_save(filename[0])
 
     def _do_load(self, filename: str):
-        """Load and check pattern definition."""
-        with open(filename, "rt") as fd:
-            data = _json.load(fd)
-        # Everything raises the expected exceptions, so no handling
-        L = data['L']
-        pos = data['positions']
-        for p in pos:
-            if len(p) != 3:
-                _lgr.error("Invalid data length in file: %s", p)
+        """Load and check pattern definition.
+
+        JSON files hold L and the positions. Numpy (.npy) and CSV files hold just an
+        Nx3 array of positions, and the current L is kept.
+        """
+        suffix = _os.path.splitext(filename)[1].lower()
+        # Reading errors raise the expected exceptions, only contents are checked
+        if suffix == '.npy':
+            L = None
+            pos = np.load(filename, mmap_mode='r')
+        elif suffix == '.csv':
+            L = None
+            pos = np.loadtxt(filename, delimiter=',', ndmin=2)
+        else:
+            with open(filename, "rb") as fd:
+                raw = fd.read()
+            data = _orjson.loads(raw) if _orjson else _json.loads(raw)
+            L = data['L']
+            try:
+                pos = np.asarray(data['positions'], dtype=float)
+            except ValueError as e:
+                for p in data['positions']:
+                    if len(p) != 3:
+                        _lgr.error("Invalid data length in file: %s", p)
+                        return
+                _lgr.error("Invalid positions in file: %s", e)
                 return
-        self.points_te.setText(list2txt(pos))
-        self._length_le.setText(str(L))
+        if pos.size and (pos.ndim != 2 or pos.shape[1] != 3):
+            _lgr.error("Invalid positions shape in file: %s", pos.shape)
+            return
+        self.points_te.setText(list2txt(pos.tolist()))
+        if L is not None:
+            self._length_le.setText(str(L))
 
     def _do_save(self, filename: str):
         """Save pattern definition."""
-        data = self._interpret()
-        with open(filename, "wt") as fd:
-            data = _json.dump(data, fd)
+        points = self._do_interpret()
+        if _orjson:
+            data = {"L": points["L"],
+                    "positions": np.ascontiguousarray(points["positions"])}
+            with open(filename, "wb") as fd:
+                fd.write(_orjson.dumps(data, option=_orjson.OPT_SERIALIZE_NUMPY))
+        else:
+            data = {"L": points["L"], "positions": points["positions"].tolist()}
+            with open(filename, "wt") as fd:
+                _json.dump(data, fd)
 
 
 if __name__ == '__main__':
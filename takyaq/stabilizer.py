@@ -18,6 +18,7 @@ Copyright (C) 2025 Andrés Zelcer and others
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import math as _math
 import numpy as _np
 import scipy as _sp
 import threading as _th
@@ -153,7 +154,6 @@ class Stabilizer(_th.Thread):
     _z_roi = None  # min/max x, min/max y
 
     _last_image: _np.ndarray = _np.empty((50, 50))
-    _pos = _np.zeros((3,))  # current position in nm
     _period = 0.150  # minumum loop time in seconds
     _reference_shift = _np.zeros((3,))
     _z_shift: _np.float64 = _np.nan
@@ -230,6 +230,7 @@ class Stabilizer(_th.Thread):
         self._calibrate_event = _th.Event()  # Unset by default
         self._move_event = _th.Event()
         self._moveto_pos = _np.zeros((3,))
+        self._pos = _np.zeros((3,))  # current position in nm
 
         self._rsp = corrector
         self._report_cb = []
@@ -952,7 +953,7 @@ class Stabilizer(_th.Thread):
             if xy_shifts is not None:
                 xy_shifts = xy_shifts + self._reference_shift[0:2]
             if self._z_stabilization or self._xy_stabilization:
-                if z_shift is _np.nan:
+                if not _math.isfinite(z_shift):
                     _lgr.warning("z shift is NAN")
                     z_shift = 0.0
                 try:
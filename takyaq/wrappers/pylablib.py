@@ -76,35 +76,31 @@ class PyLabLibKinesisPiezoControllerWrapper(_bp):
         """
         self._ctrl = stage_ctrl
         self._NM_PER_VOLT = nm_per_volt
+        self._VOLT_PER_NM = 1. / nm_per_volt
         self._channels = self._ctrl.get_all_channels()
         if len(self._channels) != 3:
             raise ValueError("Device does not have 3 channels")
+        self._ch_x, self._ch_y, self._ch_z = self._channels
+        # Bound methods, called on every stabilization step
+        self._get = stage_ctrl.get_output_voltage
+        self._set = stage_ctrl.set_output_voltage
 
     def get_position(self) -> tuple[float, float, float]:
         """Return (x, y, z) position of the piezo in nanometers."""
-        return tuple(
-            self._ctrl.get_output_voltage(channel=c) * self._NM_PER_VOLT
-            for c in self._channels
+        return (
+            self._get(channel=self._ch_x) * self._NM_PER_VOLT,
+            self._get(channel=self._ch_y) * self._NM_PER_VOLT,
+            self._get(channel=self._ch_z) * self._NM_PER_VOLT,
         )
 
     def set_position_xy(self, x: float, y: float):
         """Move to xy position specified in nanometers."""
-        [
-            self._ctrl.set_output_voltage(pos / self._NM_PER_VOLT, channel=c)
-            for (pos, c) in zip(
-                (
-                    x,
-                    y,
-                ),
-                self._channels[:2],
-            )
-        ]
+        self._set(x * self._VOLT_PER_NM, channel=self._ch_x)
+        self._set(y * self._VOLT_PER_NM, channel=self._ch_y)
 
     def set_position_z(self, z: float):
         """Move to z position, specified in nanometers."""
-        self._ctrl.set_output_voltage(
-            z / self._NM_PER_VOLT, channel=self._channels[2]
-        )
+        self._set(z * self._VOLT_PER_NM, channel=self._ch_z)
 
     def close(self):
         """Shutdown everything."""